@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+层位数据文件读写
+供 interpolate_horizon.py 和 smooth_horizon.py 共用
+
+数据按列存储为 HorizonData（x, y, z, col, row 五个等长的numpy数组），
+读取使用pandas的C解析器，写入在安装numba时并行格式化到内存映射文件中
+"""
+
+import numpy as np
+import pandas as pd
+from collections import namedtuple
+from functools import lru_cache
+import io
+import math
+import mmap
+import os
+import re
+import sys
+
+from numba_compat import NUMBA_AVAILABLE, njit, prange
+
+
+# 数据列名及对应的数据类型
+COLUMNS = ['x', 'y', 'z', 'col', 'row']
+COLUMN_DTYPES = {'x': np.float64, 'y': np.float64, 'z': np.float64, 'col': np.int32, 'row': np.int32}
+
+# 层位数据（按列存储，每个字段为等长的numpy数组）
+HorizonData = namedtuple('HorizonData', COLUMNS)
+
+# 分块读取数据部分时每块的大致字节数（块按整行切分）
+READ_CHUNK_BYTES = 64 * 1024 * 1024
+
+# 数据部分中的空行和注释行（匹配其前一行的换行符），与头部一样原样保留到 header_lines 中
+SKIPPED_LINE = re.compile(rb'\n(?=([^\S\n]*(?:#[^\n]*)?\n))')
+BLANK_LINE = re.compile(rb'\n[^\S\n]*\n')
+
+# 数据行输出格式（与SMI导出的层位文件一致）
+ROW_FORMAT = '%15.5f   %15.5f   %12.5f     %6d         %10d'
+
+# ROW_FORMAT 各字段的宽度和在记录中的结束位置，以及一条记录的长度（不含换行符）
+FIELD_WIDTHS = (15, 15, 12, 6, 10)
+FIELD_ENDS = (15, 33, 48, 59, 78)
+RECORD_WIDTH = 78
+
+
+def read_horizon_file(filename):
+    """
+    读取层位文件
+    
+    同一进程内重复读取未修改过的文件（路径、修改时间和大小均相同）时直接返回缓存的结果，
+    例如在同一个流程中先插值再平滑时，第二次读取不再解析文件
+    
+    参数:
+        filename: 输入文件路径
+        
+    返回:
+        header_lines: 文件头部信息（列表）
+        data: HorizonData，字段 x, y, z, col, row 均为只读numpy数组（缓存的多次读取共享同一份数据）
+    """
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        print(f"错误: 找不到文件 {filename}")
+        sys.exit(1)
+    
+    header_lines, data = _read_horizon_file(os.path.realpath(filename), stat.st_mtime_ns, stat.st_size)
+    return list(header_lines), data
+
+
+@lru_cache(maxsize=4)
+def _read_horizon_file(filename, mtime_ns, size):
+    """
+    实际读取层位文件，mtime_ns 和 size 只用作缓存键
+    """
+    header_lines = []
+    
+    try:
+        # 以二进制方式读取，数据块直接交给pandas，避免再次编码
+        with open(filename, 'rb') as f:
+            # 逐行读取头部，直到 "# End:" 为止
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                header_lines.append(decode_line(line))
+                if line.strip().startswith(b'# End:'):
+                    break
+            
+            # 数据部分按块读取，每块交给pandas的C解析器，只保留numpy数组，限制内存峰值
+            chunks = {name: [np.empty(0, dtype=dtype)] for name, dtype in COLUMN_DTYPES.items()}
+            while True:
+                block = f.read(READ_CHUNK_BYTES)
+                if not block:
+                    break
+                block += f.readline()
+                if not block.endswith(b'\n'):
+                    block += b'\n'
+                
+                # 空行和注释行很少出现，先用较快的查找确认存在后再逐个提取
+                lines = b'\n' + block
+                if b'#' in block or BLANK_LINE.search(lines):
+                    header_lines.extend(decode_line(line) for line in SKIPPED_LINE.findall(lines))
+                
+                for name, values in parse_data_block(block).items():
+                    chunks[name].append(values)
+    except FileNotFoundError:
+        print(f"错误: 找不到文件 {filename}")
+        sys.exit(1)
+    except Exception as e:
+        print(f"错误: 读取文件时出现问题: {e}")
+        sys.exit(1)
+    
+    data = HorizonData(*(np.concatenate(chunks[name]) for name in COLUMNS))
+    for field in data:
+        field.flags.writeable = False
+    return tuple(header_lines), data
+
+
+def decode_line(line):
+    """
+    将读取到的一行字节解码为文本，换行符统一为 '\\n'（与文本方式读取一致）
+    """
+    return line.decode('utf-8').replace('\r\n', '\n')
+
+
+def parse_data_block(block):
+    """
+    解析数据部分的一块内容
+    
+    每一行的处理方式与逐行读取时一致：x、y、z按 float() 解析，col、row按 int() 解析，
+    字段不足5个、数值无法解析或col/row超出int32范围的行被跳过，多余的字段被忽略。
+    一行是否被保留只取决于该行本身，与同一块中的其他行无关
+    
+    参数:
+        block: 由若干完整数据行组成的字节串
+        
+    返回:
+        字典 {列名: numpy数组}，数据类型见 COLUMN_DTYPES
+    """
+    float_dtypes = {name: dtype for name, dtype in COLUMN_DTYPES.items() if np.issubdtype(dtype, np.floating)}
+    try:
+        # 绝大多数数据块格式规整，直接交给pandas的C解析器：round_trip 与 float() 的结果完全一致，
+        # 不做NA识别，"NA"、"nan"、注释等与 float() 可能不一致的写法都会使解析失败，改为逐行解析
+        df = pd.read_csv(io.BytesIO(block), sep=r'\s+', header=None, names=COLUMNS,
+                         usecols=range(len(COLUMNS)), dtype=float_dtypes, na_filter=False,
+                         float_precision='round_trip', encoding='utf-8', engine='c')
+    except pd.errors.EmptyDataError:
+        return {}
+    except ValueError:
+        return parse_data_lines(block)
+    
+    # 整数列只有全部为整数写法时才会被推断为int64，再确认没有超出目标类型的范围
+    for name, dtype in COLUMN_DTYPES.items():
+        if name in float_dtypes:
+            continue
+        info = np.iinfo(dtype)
+        values = df[name].to_numpy()
+        if values.dtype != np.int64 or ((values < info.min) | (values > info.max)).any():
+            return parse_data_lines(block)
+    
+    return {name: df[name].to_numpy().astype(dtype, copy=False) for name, dtype in COLUMN_DTYPES.items()}
+
+
+def parse_data_lines(block):
+    """
+    逐行解析数据块（与原始实现相同），用于含有不规范行的数据块
+    
+    参数:
+        block: 由若干完整数据行组成的字节串
+        
+    返回:
+        字典 {列名: numpy数组}，数据类型见 COLUMN_DTYPES
+    """
+    col_info = np.iinfo(COLUMN_DTYPES['col'])
+    row_info = np.iinfo(COLUMN_DTYPES['row'])
+    
+    records = []
+    for line in block.decode('utf-8').split('\n'):
+        parts = line.split()
+        if len(parts) < len(COLUMNS) or parts[0].startswith('#'):
+            continue
+        try:
+            x = float(parts[0])
+            y = float(parts[1])
+            z = float(parts[2])
+            col = int(parts[3])
+            row = int(parts[4])
+        except ValueError:
+            continue
+        if col_info.min <= col <= col_info.max and row_info.min <= row <= row_info.max:
+            records.append((x, y, z, col, row))
+    
+    if not records:
+        return {}
+    return {name: np.array(values, dtype=COLUMN_DTYPES[name])
+            for name, values in zip(COLUMNS, zip(*records))}
+
+
+def fits_fixed_width(data):
+    """
+    检查数据能否按定长记录写出：所有数值有限且不超出 ROW_FORMAT 中各字段的宽度
+    
+    参数:
+        data: HorizonData
+        
+    返回:
+        True/False
+    """
+    if len(data.z) == 0:
+        return False
+    for field, fmt, width in zip(data, ROW_FORMAT.split(), FIELD_WIDTHS):
+        if field.dtype.kind == 'f' and not np.all(np.isfinite(field)):
+            return False
+        if len(fmt % field.min()) > width or len(fmt % field.max()) > width:
+            return False
+    return True
+
+
+@njit(cache=True)
+def round_scaled(value, scale):
+    """
+    计算 value * scale 的真实值舍入到的整数（与Python '%.nf' 格式化一致，恰好一半时取偶）
+    
+    乘积的舍入误差用Dekker算法精确求出，避免 rint(value * scale) 在接近一半时舍入方向错误
+    """
+    product = value * scale
+    split = 134217729.0  # 2**27 + 1
+    t = split * value
+    v_hi = t - (t - value)
+    v_lo = value - v_hi
+    t = split * scale
+    s_hi = t - (t - scale)
+    s_lo = scale - s_hi
+    error = ((v_hi * s_hi - product) + v_hi * s_lo + v_lo * s_hi) + v_lo * s_lo
+    
+    result = np.floor(product)
+    frac = product - result
+    if frac > 0.5 or (frac == 0.5 and (error > 0 or (error == 0 and result % 2 == 1))):
+        result += 1
+    return np.int64(result)
+
+
+@njit(cache=True)
+def write_fixed_point(buf, end, value, decimals, negative):
+    """
+    将非负整数value（已放大 10**decimals 倍）按定点小数右对齐写入 buf[:end]
+    """
+    pos = end - 1
+    digits = 0
+    while True:
+        buf[pos] = 48 + value % 10  # '0' + 末位数字
+        value //= 10
+        pos -= 1
+        digits += 1
+        if digits == decimals:
+            buf[pos] = 46  # '.'
+            pos -= 1
+        if value == 0 and digits > decimals:
+            break
+    if negative:
+        buf[pos] = 45  # '-'
+
+
+@njit(parallel=True, cache=True)
+def format_records(buf, x, y, z, col, row, newline):
+    """
+    将所有数据点按 ROW_FORMAT 格式化为定长记录写入buf，各记录互不重叠，并行计算
+    """
+    width = RECORD_WIDTH + len(newline)
+    for i in prange(len(x)):
+        start = i * width
+        buf[start:start + RECORD_WIDTH] = 32  # 空格
+        for k, value in enumerate((x[i], y[i], z[i])):
+            write_fixed_point(buf, start + FIELD_ENDS[k], abs(round_scaled(value, 1e5)), 5,
+                              math.copysign(1.0, value) < 0)
+        write_fixed_point(buf, start + FIELD_ENDS[3], abs(np.int64(col[i])), 0, col[i] < 0)
+        write_fixed_point(buf, start + FIELD_ENDS[4], abs(np.int64(row[i])), 0, row[i] < 0)
+        buf[start + RECORD_WIDTH:start + width] = newline
+
+
+def write_horizon_file(filename, header_lines, data):
+    """
+    写入层位文件
+    
+    参数:
+        filename: 输出文件路径
+        header_lines: 文件头部信息（列表）
+        data: HorizonData，按输出顺序排列
+    """
+    if not (NUMBA_AVAILABLE and fits_fixed_width(data)):
+        with open(filename, 'w', encoding='utf-8') as f_out:
+            # 写入头部
+            f_out.writelines(header_lines)
+            
+            # 所有数据点一次性格式化写入
+            np.savetxt(f_out, np.rec.fromarrays(data, names=COLUMNS), fmt=ROW_FORMAT)
+        return
+    
+    # 每条记录等长：预先设定文件大小，把记录直接并行格式化到内存映射的文件中
+    # 换行符与文本模式写入保持一致
+    header = ''.join(header_lines).replace('\n', os.linesep).encode('utf-8')
+    newline = np.frombuffer(os.linesep.encode('ascii'), dtype=np.uint8)
+    body_size = len(data.z) * (RECORD_WIDTH + len(newline))
+    
+    with open(filename, 'w+b') as f_out:
+        f_out.write(header)
+        f_out.truncate(len(header) + body_size)
+        with mmap.mmap(f_out.fileno(), len(header) + body_size) as mm:
+            buf = np.frombuffer(mm, dtype=np.uint8, count=body_size, offset=len(header))
+            format_records(buf, *data, newline)
+            del buf  # 释放对mmap的引用后才能关闭
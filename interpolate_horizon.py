@@ -20,61 +20,130 @@
 """
 
 import numpy as np
-from scipy.interpolate import griddata
-from collections import Counter
+from scipy import ndimage
 import argparse
-import sys
 import time
 
+from horizon_io import HorizonData, read_horizon_file, write_horizon_file
 
-def read_horizon_file(filename):
+
+# 插值方法对应的样条阶数（用于 ndimage.map_coordinates）
+SPLINE_ORDERS = {'nearest': 0, 'linear': 1, 'cubic': 3}
+
+
+def most_common_interval(major, minor, default=4):
+    """
+    统计同一条线上相邻两点的间隔，返回出现次数最多的间隔（排除1）
+    
+    参数:
+        major: 线的编号（如col）
+        minor: 点在线上的位置（如row）
+        default: 没有可用间隔时的默认值
+        
+    返回:
+        最常见的间隔
+    """
+    order = np.lexsort((minor, major))
+    diffs = np.diff(minor[order])
+    same_line = np.diff(major[order]) == 0
+    valid = diffs[same_line & (diffs > 1)]
+    return int(np.bincount(valid).argmax()) if valid.size else default
+
+
+def build_z_grid(data):
+    """
+    将数据点散布到 (row, col) 规则网格上
+    
+    参数:
+        data: HorizonData
+        
+    返回:
+        z_grid: z值网格，无数据的位置为NaN
+        cols: 网格各列对应的col值（升序）
+        rows: 网格各行对应的row值（升序）
+    """
+    cols, col_idx = np.unique(data.col, return_inverse=True)
+    rows, row_idx = np.unique(data.row, return_inverse=True)
+    
+    z_grid = np.full((len(rows), len(cols)), np.nan)
+    z_grid[row_idx, col_idx] = data.z
+    return z_grid, cols, rows
+
+
+def pack_keys(col, row):
+    """
+    将 (col, row) 打包为uint64键: (col << 32) | row
+    
+    参数:
+        col: col数组
+        row: row数组
+        
+    返回:
+        uint64键数组，不同的 (col, row) 对应不同的键（含负数），用于去重；
+        col为负数时键的大小顺序与 (col, row) 的顺序不一致，排序请用 np.lexsort
+    """
+    return (col.astype(np.uint64) << np.uint64(32)) | row.astype(np.uint32).astype(np.uint64)
+
+
+def fill_nearest(z_grid):
+    """
+    用最近的已知点填充网格中的NaN
+    
+    参数:
+        z_grid: z值网格
+        
+    返回:
+        填充后的z值网格
+    """
+    nearest = ndimage.distance_transform_edt(np.isnan(z_grid), return_distances=False, return_indices=True)
+    return z_grid[tuple(nearest)]
+
+
+def insert_line_points(group, pos, spacing):
+    """
+    在同一条线（同一col或同一row）上相邻的两个原始点之间按间隔插入新点
+    
+    参数:
+        group: 每个点所在线的编号（如col）
+        pos: 每个点在线上的位置（如row）
+        spacing: 插入间隔（正整数）
+        
+    返回:
+        lo, hi: 每个新点前后两个相邻原始点的下标
+        new_pos: 新点在线上的位置
+        ratio: 新点在两个相邻原始点之间的比例位置
+    """
+    order = np.lexsort((pos, group))
+    group, pos = group[order], pos[order]
+    
+    # 每个线段（同一条线上相邻的两点）内插入的点数
+    gap = np.diff(pos)
+    counts = np.where(group[1:] == group[:-1], (gap - 1) // spacing, 0)
+    counts = np.maximum(counts, 0)
+    
+    # 每个新点所属的线段，以及它在线段内的序号（1, 2, ...）
+    seg = np.repeat(np.arange(len(counts)), counts)
+    step = np.arange(len(seg)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    
+    current = pos[seg]
+    new_pos = (current + spacing * step).astype(pos.dtype)
+    ratio = (new_pos - current) / gap[seg]
+    return order[seg], order[seg + 1], new_pos, ratio
+
+
+def interp_between(values, lo, hi, ratio):
     """
-    读取层位文件
+    在两个原始点之间按比例线性插值
     
     参数:
-        filename: 输入文件路径
+        values: 原始点的取值数组（x、y或z）
+        lo, hi: 前后两个原始点的下标
+        ratio: 比例位置
         
     返回:
-        header_lines: 文件头部信息（列表）
-        data_points: 数据点列表，每个元素为字典 {'x', 'y', 'z', 'col', 'row'}
+        插值结果数组
     """
-    header_lines = []
-    data_points = []
-    in_header = True
-    
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            for line in f:
-                line_stripped = line.strip()
-                
-                if in_header or not line_stripped or line_stripped.startswith('#'):
-                    header_lines.append(line)
-                    if line_stripped.startswith('# End:'):
-                        in_header = False
-                    continue
-                
-                parts = line_stripped.split()
-                if len(parts) >= 5:
-                    try:
-                        x = float(parts[0])
-                        y = float(parts[1])
-                        z = float(parts[2])
-                        col = int(parts[3])
-                        row = int(parts[4])
-                        
-                        data_points.append({
-                            'x': x, 'y': y, 'z': z, 'col': col, 'row': row
-                        })
-                    except ValueError:
-                        pass
-    except FileNotFoundError:
-        print(f"错误: 找不到文件 {filename}")
-        sys.exit(1)
-    except Exception as e:
-        print(f"错误: 读取文件时出现问题: {e}")
-        sys.exit(1)
-    
-    return header_lines, data_points
+    return values[lo] + (values[hi] - values[lo]) * ratio
 
 
 def interpolate_horizon(input_file, output_file, target_spacing=2, method='linear'):
@@ -84,9 +153,12 @@ def interpolate_horizon(input_file, output_file, target_spacing=2, method='linea
     参数:
         input_file: 输入文件路径
         output_file: 输出文件路径
-        target_spacing: 目标间隔
+        target_spacing: 目标间隔（不小于1）
         method: 插值方法 ('linear', 'cubic', 'nearest')
     """
+    if target_spacing < 1:
+        raise ValueError(f"目标间隔必须不小于1，当前为 {target_spacing}")
+    
     print("=" * 70)
     print("层位数据插值处理工具")
     print("=" * 70)
@@ -95,81 +167,31 @@ def interpolate_horizon(input_file, output_file, target_spacing=2, method='linea
     print(f"读取文件: {input_file}")
     start_time = time.time()
     
-    header_lines, data_points = read_horizon_file(input_file)
-    print(f"读取到 {len(data_points)} 个原始数据点")
+    header_lines, data = read_horizon_file(input_file)
+    num_points = len(data.z)
+    print(f"读取到 {num_points} 个原始数据点")
     
-    if len(data_points) == 0:
+    if num_points == 0:
         print("错误: 没有读取到数据点")
         return
     
     read_time = time.time() - start_time
     print(f"读取耗时: {read_time:.2f} 秒\n")
     
-    # 建立原始数据点的映射
-    col_row_map = {(p['col'], p['row']): (p['x'], p['y'], p['z']) for p in data_points}
-    points_xy = np.array([[p['x'], p['y']] for p in data_points])
-    values_z = np.array([p['z'] for p in data_points])
-    
-    # 分析每个col实际存在的row值，以及每个row实际存在的col值
-    col_to_rows = {}  # {col: [sorted row values]}
-    row_to_cols = {}  # {row: [sorted col values]}
-    
-    for p in data_points:
-        col = p['col']
-        row = p['row']
-        if col not in col_to_rows:
-            col_to_rows[col] = []
-        if row not in row_to_cols:
-            row_to_cols[row] = []
-        col_to_rows[col].append(row)
-        row_to_cols[row].append(col)
-    
-    # 排序
-    for col in col_to_rows:
-        col_to_rows[col] = sorted(set(col_to_rows[col]))
-    for row in row_to_cols:
-        row_to_cols[row] = sorted(set(row_to_cols[row]))
-    
-    print(f"有数据的列数: {len(col_to_rows)}")
-    print(f"有数据的行数: {len(row_to_cols)}")
-    
-    # 计算当前间隔（检查同一col的不同row之间的间隔）
-    row_intervals_all = []
-    for col, rows in list(col_to_rows.items())[:100]:  # 检查前100个col
-        if len(rows) > 1:
-            for i in range(len(rows) - 1):
-                interval = rows[i+1] - rows[i]
-                if interval > 0:
-                    row_intervals_all.append(interval)
-    
-    col_intervals_all = []
-    for row, cols in list(row_to_cols.items())[:100]:  # 检查前100个row
-        if len(cols) > 1:
-            for i in range(len(cols) - 1):
-                interval = cols[i+1] - cols[i]
-                if interval > 0:
-                    col_intervals_all.append(interval)
-    
-    # 找到最常见的间隔（排除1）
-    if col_intervals_all:
-        interval_counts = Counter(col_intervals_all)
-        filtered = {k: v for k, v in interval_counts.items() if k > 1}
-        if filtered:
-            col_spacing = max(filtered.items(), key=lambda x: x[1])[0]
-        else:
-            col_spacing = 4
-    else:
-        col_spacing = 4
+    # 同一 (col, row) 出现多次时只保留最后读到的点
+    keys = pack_keys(data.col, data.row)
+    _, last = np.unique(keys[::-1], return_index=True)
+    if len(last) < num_points:
+        keep = np.sort(num_points - 1 - last)
+        data = HorizonData(*(field[keep] for field in data))
+        num_points = len(keep)
     
-    if row_intervals_all:
-        interval_counts = Counter(row_intervals_all)
-        filtered = {k: v for k, v in interval_counts.items() if k > 1}
-        if filtered:
-            row_spacing = max(filtered.items(), key=lambda x: x[1])[0]
-        else:
-            row_spacing = 4
-    else:
-        row_spacing = 4
+    print(f"有数据的列数: {len(np.unique(data.col))}")
+    print(f"有数据的行数: {len(np.unique(data.row))}")
+    
+    # 计算当前间隔：col间隔基于同一row的相邻col，row间隔基于同一col的相邻row
+    col_spacing = most_common_interval(data.row, data.col)
+    row_spacing = most_common_interval(data.col, data.row)
     
     print(f"当前列间隔: {col_spacing}, 行间隔: {row_spacing}")
     print(f"目标间隔: {target_spacing}")
@@ -177,77 +199,57 @@ def interpolate_horizon(input_file, output_file, target_spacing=2, method='linea
     
     # 生成新点：只在实际存在数据的col/row之间插入
     print("生成新点...")
-    new_points = {}  # {(col, row): (x, y, z)}
-    
-    # 首先添加所有原始点
-    for (col, row), (x, y, z) in col_row_map.items():
-        new_points[(col, row)] = (x, y, z)
-    
     # 对于每个col，在其实际存在的row值之间插入新row
-    need_interp_points = []
-    need_interp_indices = []
-    
-    for col, rows in col_to_rows.items():
-        for i in range(len(rows) - 1):
-            current_row = rows[i]
-            next_row = rows[i+1]
-            # 在current_row和next_row之间插入间隔为target_spacing的点
-            for new_row in range(current_row + target_spacing, next_row, target_spacing):
-                if (col, new_row) not in new_points:
-                    need_interp_indices.append((col, new_row))
-                    # 计算y坐标：基于同一col的相邻row点
-                    y1 = col_row_map[(col, current_row)][1]
-                    y2 = col_row_map[(col, next_row)][1]
-                    ratio = (new_row - current_row) / (next_row - current_row)
-                    new_y = y1 + (y2 - y1) * ratio
-                    # x坐标：使用同一col的x坐标（因为同一col的x应该相同或接近）
-                    new_x = col_row_map[(col, current_row)][0]
-                    need_interp_points.append((new_x, new_y))
+    # y坐标基于同一col的相邻row点线性插值，x坐标沿用同一col的x（同一col的x应该相同或接近）
+    col_lo, col_hi, col_new_rows, col_ratio = insert_line_points(data.col, data.row, target_spacing)
     
     # 对于每个row，在其实际存在的col值之间插入新col
-    for row, cols in row_to_cols.items():
-        for i in range(len(cols) - 1):
-            current_col = cols[i]
-            next_col = cols[i+1]
-            # 在current_col和next_col之间插入间隔为target_spacing的点
-            for new_col in range(current_col + target_spacing, next_col, target_spacing):
-                if (new_col, row) not in new_points:
-                    need_interp_indices.append((new_col, row))
-                    # 计算x坐标：基于同一row的相邻col点
-                    x1 = col_row_map[(current_col, row)][0]
-                    x2 = col_row_map[(next_col, row)][0]
-                    ratio = (new_col - current_col) / (next_col - current_col)
-                    new_x = x1 + (x2 - x1) * ratio
-                    # y坐标：使用同一row的y坐标
-                    new_y = col_row_map[(current_col, row)][1]
-                    need_interp_points.append((new_x, new_y))
-    
-    print(f"原始数据点: {len(new_points)} 个")
-    print(f"需要插值: {len(need_interp_points)} 个")
+    # x坐标基于同一row的相邻col点线性插值，y坐标沿用同一row的y
+    row_lo, row_hi, row_new_cols, row_ratio = insert_line_points(data.row, data.col, target_spacing)
+    
+    new_cols = np.concatenate((data.col[col_lo], row_new_cols))
+    new_rows = np.concatenate((col_new_rows, data.row[row_lo]))
+    new_xs = np.concatenate((data.x[col_lo], interp_between(data.x, row_lo, row_hi, row_ratio)))
+    new_ys = np.concatenate((interp_between(data.y, col_lo, col_hi, col_ratio), data.y[row_lo]))
+    lo = np.concatenate((col_lo, row_lo))
+    hi = np.concatenate((col_hi, row_hi))
+    ratio = np.concatenate((col_ratio, row_ratio))
+    
+    # 两个方向生成的新点可能重合：按打包键去重，保留后生成的（row方向）
+    new_keys = pack_keys(new_cols, new_rows)
+    _, last = np.unique(new_keys[::-1], return_index=True)
+    keep = np.sort(len(new_keys) - 1 - last)
+    new_cols, new_rows, new_xs, new_ys = new_cols[keep], new_rows[keep], new_xs[keep], new_ys[keep]
+    lo, hi, ratio = lo[keep], hi[keep], ratio[keep]
+    num_new = len(new_cols)
+    new_zs = np.empty(num_new)
+    
+    print(f"原始数据点: {num_points} 个")
+    print(f"需要插值: {num_new} 个")
     
     # 批量插值z值
-    if len(need_interp_points) > 0:
+    if num_new > 0:
         print(f"开始批量插值z值（方法: {method}）...\n")
         interp_start = time.time()
         
-        interp_points_xy = np.array(need_interp_points)
-        z_interpolated = griddata(points_xy, values_z, interp_points_xy, method=method, fill_value=np.nan)
-        
-        # 处理NaN值：使用nearest方法填充
-        nan_mask = np.isnan(z_interpolated)
-        if np.any(nan_mask):
-            print(f"发现 {np.sum(nan_mask)} 个NaN值，使用nearest方法填充...")
-            z_nearest = griddata(points_xy, values_z, interp_points_xy[nan_mask], method='nearest')
-            z_interpolated[nan_mask] = z_nearest
-        
-        # 添加到结果
-        for i, (new_col, new_row) in enumerate(need_interp_indices):
-            new_points[(new_col, new_row)] = (need_interp_points[i][0], need_interp_points[i][1], float(z_interpolated[i]))
+        if method == 'linear':
+            # 每个新点前后相邻的两个原始点已知，直接按比例插值
+            # （即网格上沿线方向的双线性插值，另一方向权重为0）
+            new_zs[:] = interp_between(data.z, lo, hi, ratio)
+        else:
+            # 原始数据位于 (col, row) 规则网格上，直接在网格索引空间插值
+            # 网格空缺处预先用最近的已知点填充，之后只需一次插值查询
+            z_grid, cols, rows = build_z_grid(data)
+            z_filled = fill_nearest(z_grid)
+            
+            coords = np.vstack((np.interp(new_rows, rows, np.arange(len(rows))),
+                                np.interp(new_cols, cols, np.arange(len(cols)))))
+            ndimage.map_coordinates(z_filled, coords, output=new_zs, order=SPLINE_ORDERS[method], mode='nearest')
         
         interp_time = time.time() - interp_start
         print(f"批量插值完成，耗时: {int(interp_time//60)}分{int(interp_time%60)}秒")
         if interp_time > 0:
-            print(f"平均速度: {int(len(need_interp_points)/interp_time)} 点/秒\n")
+            print(f"平均速度: {int(num_new/interp_time)} 点/秒\n")
     else:
         print("无需插值新点\n")
     
@@ -255,35 +257,25 @@ def interpolate_horizon(input_file, output_file, target_spacing=2, method='linea
     print("写入文件...")
     write_start = time.time()
     
-    # 按col和row排序
-    sorted_points = sorted(new_points.items(), key=lambda x: (x[0][0], x[0][1]))
-    total_points = len(sorted_points)
+    # 合并原始点和新点，按col和row排序
+    all_x = np.concatenate((data.x, new_xs))
+    all_y = np.concatenate((data.y, new_ys))
+    all_z = np.concatenate((data.z, new_zs))
+    all_col = np.concatenate((data.col, new_cols))
+    all_row = np.concatenate((data.row, new_rows))
+    order = np.lexsort((all_row, all_col))
+    total_points = len(order)
     
-    with open(output_file, 'w', encoding='utf-8') as f_out:
-        # 写入头部
-        for line in header_lines:
-            f_out.write(line)
-        
-        # 写入所有点
-        processed = 0
-        for (col, row), (x, y, z) in sorted_points:
-            f_out.write(f"{x:>15.5f}   {y:>15.5f}   {z:>12.5f}     {col:>6}         {row:>10}\n")
-            processed += 1
-            
-            if processed % 10000 == 0:
-                elapsed = time.time() - write_start
-                percent = processed / total_points * 100
-                speed = processed / elapsed if elapsed > 0 else 0
-                remaining = (total_points - processed) / speed if speed > 0 else 0
-                print(f"\r进度: {percent:.1f}% ({processed}/{total_points}) 速度: {int(speed)}点/秒 剩余: {int(remaining//60)}分{int(remaining%60)}秒", end='', flush=True)
+    write_horizon_file(output_file, header_lines,
+                       HorizonData(all_x[order], all_y[order], all_z[order], all_col[order], all_row[order]))
     
     total_time = time.time() - start_time
     write_time = time.time() - write_start
     
-    print(f"\n\n完成!")
-    print(f"总点数: {processed}")
-    print(f"原始数据点: {len(col_row_map)}")
-    print(f"新增插值点: {len(need_interp_points)}")
+    print(f"\n完成!")
+    print(f"总点数: {total_points}")
+    print(f"原始数据点: {num_points}")
+    print(f"新增插值点: {num_new}")
     print(f"写入耗时: {write_time:.2f} 秒")
     print(f"总耗时: {int(total_time//60)}分{int(total_time%60)}秒")
     print(f"文件已保存: {output_file}")
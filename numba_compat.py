@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+可选依赖numba的兼容层
+安装numba时提供其 njit 和 prange，未安装时退化为普通Python函数（结果相同，速度较慢）
+"""
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+    prange = range
+    NUMBA_AVAILABLE = False
@@ -22,198 +22,337 @@
 
 import numpy as np
 from scipy import ndimage
-from scipy.signal import savgol_filter
+from scipy.signal import savgol_coeffs
 import argparse
-import sys
 import time
 
+from horizon_io import HorizonData, read_horizon_file, write_horizon_file
+from numba_compat import njit, prange
 
-def read_horizon_file(filename):
+
+# 数据点占 (row, col) 网格的比例低于该值时，高斯平滑改用稀疏算法
+SPARSE_DENSITY_THRESHOLD = 0.05
+
+
+def group_indices(major, minor):
     """
-    读取层位文件
+    按major分组，组内按minor排序
     
     参数:
-        filename: 输入文件路径
+        major: 分组依据的数组（如col）
+        minor: 组内排序依据的数组（如row）
         
     返回:
-        header_lines: 文件头部信息（列表）
-        data_points: 数据点列表，每个元素为字典 {'x', 'y', 'z', 'col', 'row'}
+        order: 排序后的索引数组
+        bounds: 每组在order中的起止位置，第k组为 order[bounds[k]:bounds[k+1]]
     """
-    header_lines = []
-    data_points = []
-    in_header = True
-    
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            for line in f:
-                line_stripped = line.strip()
-                
-                if in_header or not line_stripped or line_stripped.startswith('#'):
-                    header_lines.append(line)
-                    if line_stripped.startswith('# End:'):
-                        in_header = False
-                    continue
-                
-                parts = line_stripped.split()
-                if len(parts) >= 5:
-                    try:
-                        x = float(parts[0])
-                        y = float(parts[1])
-                        z = float(parts[2])
-                        col = int(parts[3])
-                        row = int(parts[4])
-                        
-                        data_points.append({
-                            'x': x, 'y': y, 'z': z, 'col': col, 'row': row
-                        })
-                    except ValueError:
-                        pass
-    except FileNotFoundError:
-        print(f"错误: 找不到文件 {filename}")
-        sys.exit(1)
-    except Exception as e:
-        print(f"错误: 读取文件时出现问题: {e}")
-        sys.exit(1)
-    
-    return header_lines, data_points
-
-
-def smooth_gaussian(data_points, sigma=1.0):
+    order = np.lexsort((minor, major))
+    sorted_major = major[order]
+    starts = np.flatnonzero(np.diff(sorted_major)) + 1
+    bounds = np.concatenate(([0], starts, [len(order)]))
+    return order, bounds
+
+
+def grid_indices(data):
     """
-    使用高斯滤波进行平滑
+    计算每个数据点在 (row, col) 规则网格中的位置
+    
+    参数:
+        data: HorizonData
+        
+    返回:
+        row_idx: 每个数据点在网格中的行索引
+        col_idx: 每个数据点在网格中的列索引
+        shape: 网格形状 (行数, 列数)
+    """
+    cols, col_idx = np.unique(data.col, return_inverse=True)
+    rows, row_idx = np.unique(data.row, return_inverse=True)
+    return row_idx, col_idx, (len(rows), len(cols))
+
+
+def build_z_grid(data):
+    """
+    将数据点散布到 (row, col) 规则网格上
+    
+    参数:
+        data: HorizonData
+        
+    返回:
+        z_grid: z值网格，无数据的位置为NaN
+        row_idx: 每个数据点在网格中的行索引
+        col_idx: 每个数据点在网格中的列索引
+    """
+    row_idx, col_idx, shape = grid_indices(data)
+    
+    z_grid = np.full(shape, np.nan)
+    z_grid[row_idx, col_idx] = data.z
+    return z_grid, row_idx, col_idx
+
+
+@njit(cache=True)
+def clamped_weight(weight_csum, pos, center, n, radius):
+    """
+    窗口 [center-radius, center+radius] 中的位置超出 [0, n) 时按最近的边界截断，
+    返回截断后落在pos上的所有位置的权重之和（与 ndimage 的 mode='nearest' 一致）
+    
+    参数:
+        weight_csum: 一维高斯权重的累积和，首项为0
+        pos: 网格中的位置，位于窗口内
+        center: 窗口中心
+        n: 网格在该方向的长度
+        radius: 窗口半径
+        
+    返回:
+        pos上的总权重
+    """
+    lo = pos - center + radius
+    hi = lo + 1
+    if pos == 0:
+        lo = 0
+    if pos == n - 1:
+        hi = 2 * radius + 1
+    return weight_csum[hi] - weight_csum[lo]
+
+
+@njit(parallel=True, cache=True)
+def gaussian_sparse(row_idx, col_idx, values, shape, sigma, radius):
+    """
+    稀疏数据的高斯平滑：只访问实际存在的数据点，不构建稠密网格
+    
+    每个点的结果为其 ±radius 邻域内已有数据点的高斯加权平均，
+    邻域超出网格的部分按最近的边界截断（与 smooth_gaussian 的稠密算法一致）
     
     参数:
-        data_points: 数据点列表
+        row_idx, col_idx: 每个数据点在网格中的行、列索引
+        values: 数据点的z值
+        shape: 网格形状 (行数, 列数)
         sigma: 高斯平滑的标准差
+        radius: 邻域半径（网格单位）
         
     返回:
         平滑后的z值数组
     """
-    # 构建网格
-    cols = sorted(set(p['col'] for p in data_points))
-    rows = sorted(set(p['row'] for p in data_points))
+    n_rows, n_cols = shape
+    
+    # 按行优先打包的键排序后，同一行内一段连续的列在数组中也是连续的
+    keys = row_idx.astype(np.int64) * n_cols + col_idx
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    
+    # 二维高斯权重可分离为行、列两个一维权重的乘积
+    offsets = np.arange(-radius, radius + 1)
+    weights = np.exp(-0.5 * (offsets / sigma) ** 2)
+    weight_csum = np.zeros(len(weights) + 1)
+    weight_csum[1:] = np.cumsum(weights)
+    
+    smoothed = np.empty(len(values))
+    for i in prange(len(values)):
+        r, c = row_idx[i], col_idx[i]
+        c_lo, c_hi = max(0, c - radius), min(n_cols - 1, c + radius)
+        total = 0.0
+        weight_sum = 0.0
+        for rr in range(max(0, r - radius), min(n_rows, r + radius + 1)):
+            w_row = clamped_weight(weight_csum, rr, r, n_rows, radius)
+            lo = np.searchsorted(sorted_keys, rr * n_cols + c_lo)
+            hi = np.searchsorted(sorted_keys, rr * n_cols + c_hi + 1)
+            for k in range(lo, hi):
+                j = order[k]
+                w = w_row * clamped_weight(weight_csum, col_idx[j], c, n_cols, radius)
+                total += w * values[j]
+                weight_sum += w
+        smoothed[i] = total / weight_sum
+    return smoothed
+
+
+def smooth_gaussian(data, sigma=1.0):
+    """
+    使用高斯滤波进行平滑
     
-    col_to_idx = {col: i for i, col in enumerate(cols)}
-    row_to_idx = {row: i for i, row in enumerate(rows)}
+    每个点的结果为其邻域内已有数据点的高斯加权平均（归一化卷积）：
+    网格中没有数据的位置不参与计算，权重按实际参与的数据点重新归一化，因此孔洞不会把NaN扩散到周围的点；
+    邻域超出网格的部分按最近的边界截断（mode='nearest'），没有孔洞的网格结果与直接高斯滤波完全相同。
+    稀疏和稠密两种算法的结果一致
     
-    # 创建z值网格
-    z_grid = np.full((len(rows), len(cols)), np.nan)
-    col_row_map = {}
+    参数:
+        data: HorizonData
+        sigma: 高斯平滑的标准差，不大于0时不做平滑
+        
+    返回:
+        平滑后的z值数组
+    """
+    if sigma <= 0:
+        return data.z.copy()
+    
+    row_idx, col_idx, shape = grid_indices(data)
+    
+    # 数据只占网格很小一部分时，稠密网格大部分是空的，改为只在数据点上计算
+    if len(data.z) < SPARSE_DENSITY_THRESHOLD * shape[0] * shape[1]:
+        radius = int(4.0 * sigma + 0.5)  # 与 ndimage.gaussian_filter 默认的 truncate=4.0 一致
+        return gaussian_sparse(row_idx, col_idx, data.z, shape, sigma, radius)
     
-    for p in data_points:
-        col_idx = col_to_idx[p['col']]
-        row_idx = row_to_idx[p['row']]
-        z_grid[row_idx, col_idx] = p['z']
-        col_row_map[(p['col'], p['row'])] = (p['x'], p['y'])
+    # 创建z值网格和数据掩码（无数据的位置均为0）
+    z_grid = np.zeros(shape)
+    z_grid[row_idx, col_idx] = data.z
+    mask = np.zeros(shape)
+    mask[row_idx, col_idx] = 1.0
     
-    # 使用高斯滤波平滑（只对非NaN值进行平滑）
-    z_smoothed = ndimage.gaussian_filter(z_grid, sigma=sigma, mode='nearest')
+    # 分别平滑z值和掩码，两者相除即为只统计已有数据点的加权平均
+    z_sum = ndimage.gaussian_filter(z_grid, sigma=sigma, mode='nearest')
+    weight_sum = ndimage.gaussian_filter(mask, sigma=sigma, mode='nearest')
     
     # 将结果映射回数据点
-    smoothed_z_values = {}
-    for p in data_points:
-        col_idx = col_to_idx[p['col']]
-        row_idx = row_to_idx[p['row']]
-        smoothed_z_values[(p['col'], p['row'])] = z_smoothed[row_idx, col_idx]
+    return z_sum[row_idx, col_idx] / weight_sum[row_idx, col_idx]
+
+
+def savgol_kernels(window_length, polyorder):
+    """
+    预先计算Savitzky-Golay滤波系数
+    
+    参数:
+        window_length: 窗口长度（奇数）
+        polyorder: 多项式阶数
+        
+    返回:
+        coeffs: 中间部分的卷积核
+        head, tail: 两端各 window_length//2 个点的多项式拟合系数（与 savgol_filter 的 mode='interp' 一致）
+    """
+    half = window_length // 2
+    coeffs = savgol_coeffs(window_length, polyorder)
+    head = np.array([savgol_coeffs(window_length, polyorder, pos=i, use='dot')
+                     for i in range(half)]).reshape(half, window_length)
+    tail = np.array([savgol_coeffs(window_length, polyorder, pos=window_length - half + i, use='dot')
+                     for i in range(half)]).reshape(half, window_length)
+    return coeffs, head, tail
+
+
+def apply_savgol(z, kernels, axis):
+    """
+    沿axis方向应用预先计算好的Savitzky-Golay滤波系数
     
-    return smoothed_z_values
+    参数:
+        z: 待滤波的数组，axis方向的长度不小于窗口长度
+        kernels: savgol_kernels 的返回值
+        axis: 滤波方向
+        
+    返回:
+        滤波后的数组
+    """
+    coeffs, head, tail = kernels
+    window_length, half = len(coeffs), len(head)
+    
+    z = np.moveaxis(z, axis, 0)
+    smoothed = ndimage.convolve1d(z, coeffs, axis=0, mode='nearest')
+    if half > 0:
+        # 两端用窗口内的多项式拟合值替换
+        smoothed[:half] = np.tensordot(head, z[:window_length], axes=1)
+        smoothed[-half:] = np.tensordot(tail, z[-window_length:], axes=1)
+    return np.moveaxis(smoothed, 0, axis)
 
 
-def smooth_savgol(data_points, window_length=3, polyorder=2):
+def smooth_savgol(data, window_length=3, polyorder=2):
     """
     使用Savitzky-Golay滤波器进行平滑
     
     参数:
-        data_points: 数据点列表
+        data: HorizonData
         window_length: 窗口长度（必须为奇数）
         polyorder: 多项式阶数
         
     返回:
-        平滑后的z值字典
+        平滑后的z值数组
     """
     # 确保窗口长度为奇数
     if window_length % 2 == 0:
         window_length += 1
     
-    # 按列和行分组处理
-    smoothed_z_values = {}
+    # 列、行两个方向共用同一组滤波系数
+    kernels = savgol_kernels(window_length, polyorder)
+    
+    z_grid, row_idx, col_idx = build_z_grid(data)
+    mask = ~np.isnan(z_grid)
+    
+    # 空缺位置用最近的已知点填充，避免NaN在滤波中扩散
+    nearest = ndimage.distance_transform_edt(~mask, return_distances=False, return_indices=True)
+    z_filled = z_grid[tuple(nearest)]
+    
+    # 按列处理（axis=0），只对点数足够的列滤波，其余列保持原值
+    z_col = z_filled
+    cols_ok = np.flatnonzero(mask.sum(axis=0) >= window_length)
+    if z_grid.shape[0] >= window_length and len(cols_ok) > 0:
+        z_col[:, cols_ok] = apply_savgol(z_filled[:, cols_ok], kernels, axis=0)
+    z_smoothed = z_col[row_idx, col_idx]
+    
+    # 按行处理（axis=1，对列方向进行二次平滑），点数太少的行保持列方向结果
+    rows_ok = mask.sum(axis=1) >= window_length
+    if z_grid.shape[1] >= window_length and np.any(rows_ok):
+        z_row = apply_savgol(z_col[rows_ok], kernels, axis=1)
+        # 取列方向和行方向的平均值（只在数据点处计算）
+        sel = rows_ok[row_idx]
+        row_pos = np.cumsum(rows_ok) - 1
+        z_smoothed[sel] = 0.5 * (z_smoothed[sel] + z_row[row_pos[row_idx[sel]], col_idx[sel]])
+    
+    return z_smoothed
+
+
+@njit(parallel=True, cache=True)
+def moving_average_groups(values, order, bounds, window):
+    """
+    对每组（每个col或每个row）分别做移动平均，各组并行计算
     
-    # 按列处理
-    cols = sorted(set(p['col'] for p in data_points))
-    for col in cols:
-        col_points = [p for p in data_points if p['col'] == col]
-        col_points.sort(key=lambda p: p['row'])
-        
-        if len(col_points) >= window_length:
-            z_values = np.array([p['z'] for p in col_points])
-            z_smooth = savgol_filter(z_values, window_length, polyorder)
-            for i, p in enumerate(col_points):
-                smoothed_z_values[(p['col'], p['row'])] = z_smooth[i]
-        else:
-            # 如果点数太少，保持原值
-            for p in col_points:
-                smoothed_z_values[(p['col'], p['row'])] = p['z']
-    
-    # 按行处理（对列方向进行二次平滑）
-    rows = sorted(set(p['row'] for p in data_points))
-    for row in rows:
-        row_points = [p for p in data_points if p['row'] == row]
-        row_points.sort(key=lambda p: p['col'])
+    与 np.convolve(v, np.ones(window)/window, mode='same') 的结果一致（窗口外按0计）
+    
+    参数:
+        values: 待平滑的数组
+        order, bounds: group_indices 的返回值
+        window: 窗口大小
         
-        if len(row_points) >= window_length:
-            z_values = np.array([smoothed_z_values.get((p['col'], p['row']), p['z']) for p in row_points])
-            z_smooth = savgol_filter(z_values, window_length, polyorder)
-            for i, p in enumerate(row_points):
-                # 取列方向和行方向的平均值
-                original = smoothed_z_values.get((p['col'], p['row']), p['z'])
-                smoothed_z_values[(p['col'], p['row'])] = (original + z_smooth[i]) / 2.0
-        else:
-            for p in row_points:
-                if (p['col'], p['row']) not in smoothed_z_values:
-                    smoothed_z_values[(p['col'], p['row'])] = p['z']
-    
-    return smoothed_z_values
-
-
-def smooth_moving_average(data_points, window=3):
+    返回:
+        平滑后的数组（与values顺序相同）
+    """
+    smoothed = np.empty_like(values)
+    for g in prange(len(bounds) - 1):
+        start = bounds[g]
+        n = bounds[g + 1] - start
+        offset = (min(n, window) - 1) // 2
+        # 滑动窗口累加和：窗口 [lo, hi) 每次右移只加入/移出一个点，复杂度与窗口大小无关
+        total = 0.0
+        lo = 0
+        hi = 0
+        for i in range(n):
+            k = i + offset
+            while hi < min(n, k + 1):
+                total += values[order[start + hi]]
+                hi += 1
+            while lo < max(0, k - window + 1):
+                total -= values[order[start + lo]]
+                lo += 1
+            smoothed[order[start + i]] = total / window
+    return smoothed
+
+
+def smooth_moving_average(data, window=3):
     """
     使用移动平均进行平滑
     
     参数:
-        data_points: 数据点列表
-        window: 窗口大小
+        data: HorizonData
+        window: 窗口大小（不小于1）
         
     返回:
-        平滑后的z值字典
+        平滑后的z值数组
     """
-    smoothed_z_values = {}
+    if window < 1:
+        raise ValueError(f"移动平均窗口大小必须不小于1，当前为 {window}")
     
     # 按列处理
-    cols = sorted(set(p['col'] for p in data_points))
-    for col in cols:
-        col_points = [p for p in data_points if p['col'] == col]
-        col_points.sort(key=lambda p: p['row'])
-        
-        z_values = np.array([p['z'] for p in col_points])
-        z_smooth = np.convolve(z_values, np.ones(window)/window, mode='same')
-        
-        for i, p in enumerate(col_points):
-            smoothed_z_values[(p['col'], p['row'])] = z_smooth[i]
+    order, bounds = group_indices(data.col, data.row)
+    z_col = moving_average_groups(data.z, order, bounds, window)
     
     # 按行处理
-    rows = sorted(set(p['row'] for p in data_points))
-    for row in rows:
-        row_points = [p for p in data_points if p['row'] == row]
-        row_points.sort(key=lambda p: p['col'])
-        
-        z_values = np.array([smoothed_z_values.get((p['col'], p['row']), p['z']) for p in row_points])
-        z_smooth = np.convolve(z_values, np.ones(window)/window, mode='same')
-        
-        for i, p in enumerate(row_points):
-            original = smoothed_z_values.get((p['col'], p['row']), p['z'])
-            smoothed_z_values[(p['col'], p['row'])] = (original + z_smooth[i]) / 2.0
+    order, bounds = group_indices(data.row, data.col)
+    z_row = moving_average_groups(z_col, order, bounds, window)
     
-    return smoothed_z_values
+    return (z_col + z_row) / 2.0
 
 
 def smooth_horizon(input_file, output_file, method='gaussian', sigma=1.0, window=3):
@@ -235,10 +374,11 @@ def smooth_horizon(input_file, output_file, method='gaussian', sigma=1.0, window
     print(f"读取文件: {input_file}")
     start_time = time.time()
     
-    header_lines, data_points = read_horizon_file(input_file)
-    print(f"读取到 {len(data_points)} 个数据点")
+    header_lines, data = read_horizon_file(input_file)
+    num_points = len(data.z)
+    print(f"读取到 {num_points} 个数据点")
     
-    if len(data_points) == 0:
+    if num_points == 0:
         print("错误: 没有读取到数据点")
         return
     
@@ -250,13 +390,13 @@ def smooth_horizon(input_file, output_file, method='gaussian', sigma=1.0, window
     smooth_start = time.time()
     
     if method == 'gaussian':
-        smoothed_z = smooth_gaussian(data_points, sigma=sigma)
+        smoothed_z = smooth_gaussian(data, sigma=sigma)
         print(f"高斯平滑参数: sigma = {sigma}")
     elif method == 'savgol':
-        smoothed_z = smooth_savgol(data_points, window_length=window)
+        smoothed_z = smooth_savgol(data, window_length=window)
         print(f"Savitzky-Golay平滑参数: window = {window}")
     elif method == 'moving_average':
-        smoothed_z = smooth_moving_average(data_points, window=window)
+        smoothed_z = smooth_moving_average(data, window=window)
         print(f"移动平均平滑参数: window = {window}")
     else:
         print(f"错误: 未知的平滑方法 '{method}'")
@@ -271,27 +411,17 @@ def smooth_horizon(input_file, output_file, method='gaussian', sigma=1.0, window
     write_start = time.time()
     
     # 按col和row排序
-    sorted_points = sorted(data_points, key=lambda p: (p['col'], p['row']))
+    order = np.lexsort((data.row, data.col))
     
-    with open(output_file, 'w', encoding='utf-8') as f_out:
-        # 写入头部
-        for line in header_lines:
-            f_out.write(line)
-        
-        # 写入平滑后的数据点
-        for p in sorted_points:
-            col, row = p['col'], p['row']
-            x, y = p['x'], p['y']
-            z = smoothed_z.get((col, row), p['z'])  # 如果找不到，使用原值
-            
-            f_out.write(f"{x:>15.5f}   {y:>15.5f}   {z:>12.5f}     {col:>6}         {row:>10}\n")
+    smoothed = data._replace(z=smoothed_z)
+    write_horizon_file(output_file, header_lines, HorizonData(*(field[order] for field in smoothed)))
     
     write_time = time.time() - write_start
     total_time = time.time() - start_time
     
     print(f"写入耗时: {write_time:.2f} 秒")
     print(f"\n完成!")
-    print(f"总点数: {len(sorted_points)}")
+    print(f"总点数: {num_points}")
     print(f"总耗时: {total_time:.2f} 秒")
     print(f"文件已保存: {output_file}")
     print("=" * 70)